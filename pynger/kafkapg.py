@@ -1,10 +1,34 @@
 from argparse import ArgumentParser, FileType, Namespace
 import contextlib
+import datetime
 import json
+import msgpack
+from operator import itemgetter
 import psycopg2
-from pykafka import KafkaClient, SslConfig, SimpleConsumer
+from confluent_kafka import Consumer, TopicPartition
 import signal
-from typing import Dict, Union
+import threading
+from typing import Dict, List, Tuple, Union
+
+# Maximum number of metrics written to the database at once
+BATCH_SIZE = 1000
+# Maximum time (in seconds) a metric waits in a batch before being written
+BATCH_TIMEOUT = 0.5
+
+_INSERT_SQL = "EXECUTE insert_metrics (%s, %s, %s, %s, %s, %s, %s, %s, %s);"
+# Picks the values of a metric in the column order of _INSERT_SQL
+_extract = itemgetter(
+    "timestamp",
+    "tcp_exception",
+    "tcp_rt",
+    "http_rt",
+    "initial_response_code",
+    "num_redirects",
+    "total_rt",
+    "final_response_code",
+    "content_found"
+)
+_LEGACY_TIMESTAMP_FORMATS = ("%Y-%m-%dT%H:%M:%S.%f%z", "%Y-%m-%dT%H:%M:%S%z", "%Y-%m-%d %H:%M:%S%z")
 
 
 @contextlib.contextmanager
@@ -23,14 +47,24 @@ def connect(config: Dict[str, Union[str, int]]):
             conn.close()
 
 
-def connect_kafka(config: Dict[str, Union[str, int]]) -> KafkaClient:
-    # https://github.com/Parsely/pykafka
-    ssl_config = SslConfig(cafile=config["cafile"],
-                           certfile=config["certfile"],
-                           keyfile=config["keyfile"])
-    client = KafkaClient(hosts=config["hosts"],
-                         ssl_config=ssl_config)
-    return client
+def connect_kafka(config: Dict[str, Union[str, int]]) -> Consumer:
+    # https://github.com/confluentinc/confluent-kafka-python
+    consumer = Consumer({
+        "bootstrap.servers": config["hosts"],
+        "security.protocol": "SSL",
+        "ssl.ca.location": config["cafile"],
+        "ssl.certificate.location": config["certfile"],
+        "ssl.key.location": config["keyfile"],
+        "group.id": config.get("group_id", "kafkapg"),
+        # Offsets are committed manually, once the metrics are in the database
+        "enable.auto.commit": False,
+        # A new group starts from the oldest metrics, like pykafka's consumer did.
+        # Whatever was already written is ignored on insert
+        "auto.offset.reset": "earliest",
+        "fetch.min.bytes": 65536
+    })
+    consumer.subscribe([config["topic"]])
+    return consumer
 
 
 def parse_args() -> Namespace:
@@ -62,60 +96,113 @@ def ensure_table(pg_config):
         """)
 
 
-def start_postgresql_writer(consumer: SimpleConsumer, pg_config: Dict[str, Union[str, int]]):
+def prepare_insert_metrics(curs):
+    # Parsed and planned once per connection. Every batch is then bound as one array per column
+    curs.execute("""
+        PREPARE insert_metrics (
+            TIMESTAMPTZ[], TEXT[], FLOAT[], FLOAT[], SMALLINT[], SMALLINT[], FLOAT[], SMALLINT[], BOOLEAN[]
+        ) AS
+        INSERT INTO metric
+        (
+            created_at,
+            tcp_exception,
+            tcp_rt,
+            http_rt,
+            initial_rc,
+            num_redirects,
+            total_rt,
+            final_rc,
+            content_found
+        )
+        SELECT * FROM unnest($1, $2, $3, $4, $5, $6, $7, $8, $9)
+        ON CONFLICT (created_at) DO NOTHING;
+    """)
+
+
+def insert_metrics(curs, rows: List[tuple]):
+    # Transpose the rows into columns
+    columns = tuple(map(list, zip(*rows)))
+    curs.execute(_INSERT_SQL, columns)
+
+
+def write_batch(conn, curs, consumer: Consumer, rows: List[tuple], offsets: List[TopicPartition]):
+    # A batch may consist of skipped messages only
+    if rows:
+        insert_metrics(curs, rows)
+        conn.commit()
+    # Only acknowledge the messages once they're safely in the database
+    consumer.commit(offsets=offsets, asynchronous=False)
+
+
+def parse_legacy_timestamp(timestamp: str) -> datetime.datetime:
+    # "2020-01-01T00:00:00.123456Z" as written with orjson, or "2020-01-01 00:00:00+0000" from before
+    for timestamp_format in _LEGACY_TIMESTAMP_FORMATS:
+        try:
+            return datetime.datetime.strptime(timestamp, timestamp_format)
+        except ValueError:
+            pass
+    raise ValueError(f"Unknown timestamp format: {timestamp}")
+
+
+def row_from_message(message) -> tuple:
+    value = message.value()
+    # Msgpack maps never start with "{", JSON objects always do
+    if value[:1] == b'{':
+        # Written by an earlier version of the producer, during an upgrade
+        metric = json.loads(value)
+        metric["timestamp"] = parse_legacy_timestamp(metric["timestamp"])
+    else:
+        # Timestamps come out as timezone-aware datetimes
+        metric = msgpack.unpackb(value, timestamp=3)
+    return _extract(metric)
+
+
+def read_batch(messages) -> Tuple[List[tuple], List[TopicPartition]]:
+    rows = []
+    # Offset to resume from, for each partition in the batch
+    offsets = {}
+    for message in messages:
+        if message.error():
+            print(f"Kafka error: {message.error()}")
+            continue
+        try:
+            rows.append(row_from_message(message))
+        except (msgpack.ExtraData, ValueError, KeyError, TypeError) as e:
+            # Still acknowledged below, otherwise the writer would stumble on it again after every restart
+            print(f"Skipping undecodable message at offset {message.offset()}: {e!r}")
+        partition = (message.topic(), message.partition())
+        offsets[partition] = TopicPartition(*partition, message.offset() + 1)
+    return rows, list(offsets.values())
+
+
+def start_postgresql_writer(consumer: Consumer, pg_config: Dict[str, Union[str, int]], stop: threading.Event):
     with connect(pg_config) as (conn, curs):
-        curs.execute("""
-            PREPARE insert_metric AS
-            INSERT INTO metric
-            (
-                created_at,
-                tcp_exception,
-                tcp_rt,
-                http_rt,
-                initial_rc,
-                num_redirects,
-                total_rt,
-                final_rc,
-                content_found
-            )
-            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
-            ON CONFLICT (created_at) DO NOTHING;
-        """)
-        for message in consumer:
-            if message is not None:
-                metric = json.loads(message.value.decode('utf-8'))
-                curs.execute("""
-                    EXECUTE insert_metric (%s, %s, %s, %s, %s, %s, %s, %s, %s);
-                """, (
-                    metric["timestamp"],
-                    metric["tcp_exception"],
-                    metric["tcp_rt"],
-                    metric["http_rt"],
-                    metric["initial_response_code"],
-                    metric["num_redirects"],
-                    metric["total_rt"],
-                    metric["final_response_code"],
-                    metric["content_found"]
-                ))
-                # Commit once every 16 messages
-                if message.offset & 0xF == 0xF:
-                    conn.commit()
+        prepare_insert_metrics(curs)
+        while not stop.is_set():
+            # Up to BATCH_SIZE messages, or whatever arrived within BATCH_TIMEOUT seconds
+            rows, offsets = read_batch(consumer.consume(num_messages=BATCH_SIZE, timeout=BATCH_TIMEOUT))
+            if offsets:
+                write_batch(conn, curs, consumer, rows, offsets)
 
 
 def work(args):
+    stop = threading.Event()
+
     # Inspired by https://stackoverflow.com/a/31464349
     def proper_exit(signum, frame):
-        exit()
+        stop.set()
 
     signal.signal(signal.SIGINT, proper_exit)
     signal.signal(signal.SIGTERM, proper_exit)
 
     ensure_table(args.config["postgresql"])
 
-    kafka_conn = connect_kafka(args.config["kafka"])
-    topic = kafka_conn.topics[args.config["kafka"]["topic"]]
-    consumer = topic.get_simple_consumer()
-    start_postgresql_writer(consumer, args.config["postgresql"])
+    consumer = connect_kafka(args.config["kafka"])
+    try:
+        start_postgresql_writer(consumer, args.config["postgresql"], stop)
+    finally:
+        consumer.close()
+    print("Exiting")
 
 
 def main():
@@ -1,16 +1,31 @@
 from argparse import ArgumentParser, FileType, Namespace
+import codecs
 from contextlib import contextmanager
 import datetime
+import functools
+import http.client
 import json
-import pytz
-from pykafka import KafkaClient, SslConfig, Producer
+import msgpack
+import operator
+import queue
+from confluent_kafka import Producer
 import re
 import signal
 import socket
+import ssl
+import threading
 import time
 from types import SimpleNamespace
-from typing import Tuple, Union
-import urllib3
+from typing import Pattern, Tuple, Union
+from urllib.parse import SplitResult, urljoin, urlsplit, urlunsplit
+
+_CHARSET_RE = re.compile(r'charset\s*=\s*"?([^";\s]+)', re.I)
+# Expressions made only of plain characters and escaped punctuation, which match the same text however it is decoded
+_LITERAL_RE = re.compile(r'(?:[^\\.^$*+?{}\[\]|()]|\\[^0-9A-Za-z])*')
+# Charsets in which ASCII bytes always stand for ASCII characters (unlike Shift_JIS trail bytes, UTF-16, ...)
+_RAW_CHARSETS = {'ascii', 'utf-8', 'iso8859-1'}
+# Maximum time (in seconds) to wait for the delivery of pending metrics on exit
+FLUSH_TIMEOUT = 10
 
 
 class MaxRedirectError(OSError):
@@ -21,7 +36,7 @@ class MaxRedirectError(OSError):
 
 class Metric:
     __slots__ = (
-        "pool",
+        "conn",
         "tcp_exception",
         "tcp_rt",
         "http_rt",
@@ -32,14 +47,17 @@ class Metric:
         "content_found",
         "timestamp"
     )
+    # We don't need the connection in the end dictionary
+    _DICT_KEYS = tuple(key for key in __slots__ if key != "conn")
+    # Fetches all the values at once, in the order of _DICT_KEYS
+    _get_values = operator.attrgetter(*_DICT_KEYS)
 
-    def __init__(self):
-        # Pool of 1 connection, because we want to measure how long it takes to create one
-        # and not to re-use existing
-        self.pool = urllib3.PoolManager(maxsize=1)
-        self.pool.__enter__()
+    def __init__(self, conn: Union[http.client.HTTPConnection, None] = None):
+        # Shared connection to the target host, needed only for time_http. Bound to the host once
+        # so the URL isn't parsed again on every request
+        self.conn = conn
 
-        # Exception (if any) that is raised during TCP connect
+        # Exception (if any) that is raised during TCP connect, or while waiting for the HTTP response
         self.tcp_exception: Union[Exception, None] = None
         # Response time of TCP connection
         self.tcp_rt: float = 0
@@ -56,37 +74,27 @@ class Metric:
         # Shows whether requested content was found
         self.content_found: Union[bool, None] = None
         # The timestamp of the creation of the metric object
-        self.timestamp = datetime.datetime.now(tz=pytz.utc)
-
-    def __del__(self):
-        self.pool.__exit__(None, None, None)
+        self.timestamp = datetime.datetime.now(tz=datetime.timezone.utc)
 
     @contextmanager
-    def connect(self, url: str, http_pool: urllib3.PoolManager):
-        response = None
+    def connect(self, path: str, conn: http.client.HTTPConnection):
         try:
-            # Let the library handle just the HTTP and SSL overhead
-            # while we need the details of the communications.
-            # This is why we don't want to ignore failures or redirects
-            response = http_pool.request(
-                'GET',
-                url,
-                preload_content=False,
-                retries=False,
-                redirect=False
-            )
-            yield response
+            # Talk plain HTTP by hand, because we need the details of the communications.
+            # This is why there are no retries and no redirects handled here
+            conn.request('GET', path)
+            yield conn.getresponse()
         finally:
-            if response:
-                response.release_conn()
+            # Close the connection, because we want to measure how long it takes to create one
+            # and not to re-use existing
+            conn.close()
 
     def time_connect(self, host: str, port: int, timeout: float = 1):
         sock = socket.socket()
         sock.settimeout(timeout)
-        start = time.monotonic_ns()
+        start = time.perf_counter()
         try:
             sock.connect((host, port))
-            self.tcp_rt = (time.monotonic_ns() - start) * 1.0E-6
+            self.tcp_rt = (time.perf_counter() - start) * 1000.0
         except socket.gaierror:
             self.tcp_exception = socket.gaierror(-2, f"Could not resolve host name: {host}")
         except ConnectionRefusedError:
@@ -96,38 +104,84 @@ class Metric:
         finally:
             sock.close()
 
-    def time_http(self, url: str, follow_redirect: bool) -> Tuple[bytes, Union[str, None]]:
-        while True:
-            if self.num_redirects > 20:
-                raise MaxRedirectError("Too many redirects (more than 20)")
-            start = time.monotonic_ns()
-            response: urllib3.HTTPResponse
-            with self.connect(url, self.pool) as response:
-                time_delta = (time.monotonic_ns() - start) * 1.0E-6
-                self.total_rt += time_delta
-                self.final_response_code = response.status
-                if not self.initial_response_code:
-                    self.http_rt = time_delta
-                    self.initial_response_code = response.status
-                if follow_redirect and 300 <= response.status < 400:
-                    url = response.headers['Location']
-                    self.num_redirects += 1
-                else:
-                    return response.data, response.getheader('content-type', None)
+    def time_http(self, url: SplitResult, follow_redirect: bool,
+                  need_body: bool = True) -> Tuple[bytes, Union[str, None]]:
+        if self.conn is None:
+            raise ValueError("Timing HTTP requests needs a Metric created with a connection")
+        conn = self.conn
+        perf_counter = time.perf_counter
+        try:
+            while True:
+                if self.num_redirects > 20:
+                    raise MaxRedirectError("Too many redirects (more than 20)")
+                start = perf_counter()
+                response: http.client.HTTPResponse
+                with self.connect(request_path(url), conn) as response:
+                    # Milliseconds
+                    time_delta = (perf_counter() - start) * 1000.0
+                    self.total_rt += time_delta
+                    self.final_response_code = response.status
+                    if not self.initial_response_code:
+                        self.http_rt = time_delta
+                        self.initial_response_code = response.status
+                    if follow_redirect and 300 <= response.status < 400:
+                        location = urlsplit(urljoin(url.geturl(), response.getheader('Location')))
+                        # Only open a new connection when redirected to another host
+                        if (location.scheme, location.netloc) != (url.scheme, url.netloc):
+                            if conn is not self.conn:
+                                conn.close()
+                            conn = open_connection(location, timeout=self.conn.timeout)
+                        url = location
+                        self.num_redirects += 1
+                    else:
+                        # The connection gets closed anyway, so an unneeded body is simply never downloaded
+                        data = response.read() if need_body else b''
+                        return data, response.getheader('content-type', None)
+        except (TimeoutError, socket.timeout):
+            # A host that accepts the connection but then stalls counts as a failed probe
+            self.tcp_exception = TimeoutError(f"No response within {conn.timeout} seconds")
+            return b'', None
+        except (OSError, http.client.HTTPException) as e:
+            # So does one that hangs up, resets the connection, fails the TLS handshake or redirects endlessly
+            self.tcp_exception = e
+            return b'', None
+        finally:
+            if conn is not self.conn:
+                conn.close()
 
     def keys(self):
         # Implement dict conversion with keys() and __getitem__
         # Inspired by this: https://stackoverflow.com/a/35282286
-
-        # Copy the slots into a list
-        result = list(self.__class__.__slots__)
-        # We don't need the pool in the end dictionary
-        result.remove('pool')
-        return result
+        return Metric._DICT_KEYS
 
     def __getitem__(self, key):
         return getattr(self, key)
 
+    def as_dict(self) -> dict:
+        # Same as dict(self), without a lookup per key
+        return dict(zip(Metric._DICT_KEYS, Metric._get_values(self)))
+
+
+def parse_url(url_str: str) -> SplitResult:
+    # Assume plain HTTP for URLs without a scheme, like "google.com"
+    if '://' not in url_str:
+        url_str = 'http://' + url_str
+    return urlsplit(url_str)
+
+
+def request_path(url: SplitResult) -> str:
+    # Convert this "https://example.com/foo?bar=1#baz" to this: "/foo?bar=1"
+    return urlunsplit(('', '', url.path or '/', url.query, ''))
+
+
+def open_connection(url: SplitResult, timeout: float = 10) -> http.client.HTTPConnection:
+    # The connection is only opened on the first request.
+    # The timeout applies to connecting and to every read from the socket
+    if url.scheme == 'https':
+        return http.client.HTTPSConnection(url.hostname, url.port, timeout=timeout,
+                                           context=ssl.create_default_context())
+    return http.client.HTTPConnection(url.hostname, url.port, timeout=timeout)
+
 
 def enrich_args(args: Namespace) -> SimpleNamespace:
     """ Stick default config, file config, and CLI args on top of each other
@@ -136,7 +190,9 @@ def enrich_args(args: Namespace) -> SimpleNamespace:
     """
     default_config = {
         "delay": 60,
-        "follow_redirect": False
+        "follow_redirect": False,
+        "search_in_content": None,
+        "timeout": 10
     }
     config = json.load(args.config)
     operation_config = config["operation"]
@@ -182,83 +238,165 @@ def parse_args():
         type=FileType('r', encoding='UTF-8')
     )
     args = enrich_args(parser.parse_args())
+    # Compile once, the expression is searched for in every metric
+    if args.search_in_content:
+        args.search_in_content = re.compile(args.search_in_content)
     return args
 
 
-def get_charset(content_type_str: str) -> Union[str, None]:
-    if content_type_str:
-        # Convert this "text/html; charset=UTF-8" to this: "UTF-8"
-        components = map(lambda s: s.split('='), map(str.strip, content_type_str.split(';')))
-        for c in components:
-            if c[0].lower().strip() == 'charset':
-                return c[1].strip()
+@functools.lru_cache(maxsize=32)
+def get_raw_literal(regex: Pattern) -> Union[bytes, None]:
+    # The bytes an ASCII literal expression stands for. Anything else (wildcards, classes, escapes,
+    # quantifiers, flags) may count or match characters differently on raw bytes
+    if (not regex.pattern.isascii() or regex.flags & (re.IGNORECASE | re.VERBOSE)
+            or not _LITERAL_RE.fullmatch(regex.pattern)):
+        return None
+    return re.sub(r'\\(.)', r'\1', regex.pattern, flags=re.S).encode('ascii')
 
 
-def match_content(regex: str, data: bytes, content_type_str: Union[str, None]) -> bool:
+@functools.lru_cache(maxsize=32)
+def is_raw_searchable(charset: str) -> bool:
+    try:
+        return codecs.lookup(charset).name in _RAW_CHARSETS
+    except LookupError:
+        return False
+
+
+def get_charset(content_type_str: Union[str, None]) -> Union[str, None]:
+    # Convert this "text/html; charset=UTF-8" to this: "UTF-8"
+    match = _CHARSET_RE.search(content_type_str or '')
+    return match.group(1) if match else None
+
+
+@functools.lru_cache(maxsize=32)
+def get_decoder(charset: str):
+    # Look the codec up once per charset rather than on every decode
+    return codecs.lookup(charset).decode
+
+
+def match_content(regex: Pattern, data: bytes, content_type_str: Union[str, None]) -> bool:
     charset = get_charset(content_type_str) or 'UTF-8'
+    literal = get_raw_literal(regex)
+    # Search the raw body when the result can't differ, rather than decoding it into a second copy
+    if literal is not None and is_raw_searchable(charset):
+        return literal in data
     try:
-        strdata = data.decode(charset)
-        return re.search(regex, strdata) is not None
-    except ValueError:
+        strdata, _ = get_decoder(charset)(data)
+        return regex.search(strdata) is not None
+    except (LookupError, ValueError):
         return False
 
 
 def format_unsupported_types(obj):
-    if isinstance(obj, datetime.date) or isinstance(obj, datetime.datetime):
-        return datetime.datetime.strftime(obj, "%Y-%m-%d %H:%M:%S%z")
-    # Otherwise just str it
+    # msgpack handles datetimes natively, so whatever reaches here (exceptions) is just str-ed
     return str(obj)
 
 
-def connect_kafka(config):
-    # https://github.com/Parsely/pykafka
-    ssl_config = SslConfig(cafile=config["cafile"],
-                           certfile=config["certfile"],
-                           keyfile=config["keyfile"])
-    client = KafkaClient(hosts=config["hosts"],
-                         ssl_config=ssl_config)
-    return client
+def connect_kafka(config) -> Producer:
+    # https://github.com/confluentinc/confluent-kafka-python
+    producer = Producer({
+        "bootstrap.servers": config["hosts"],
+        "security.protocol": "SSL",
+        "ssl.ca.location": config["cafile"],
+        "ssl.certificate.location": config["certfile"],
+        "ssl.key.location": config["keyfile"],
+        "acks": "1",
+        # Let the client accumulate metrics into large compressed batches,
+        # amortizing the fixed cost of each request to the broker
+        "linger.ms": 100,
+        "batch.num.messages": 10000,
+        "compression.type": "lz4",
+        "queue.buffering.max.kbytes": 1048576
+    })
+    return producer
+
+
+def report_delivery(err, msg):
+    if err is not None:
+        print(f"Failed to deliver metric: {err}")
+
+
+def produce(producer: Producer, topic: str, metric: Metric, stop: threading.Event):
+    value = msgpack.packb(metric.as_dict(), datetime=True, default=format_unsupported_types)
+    while not stop.is_set():
+        try:
+            producer.produce(topic, value=value, callback=report_delivery)
+            break
+        except BufferError:
+            # The producer's own queue is full while Kafka is unreachable. Waiting here lets the metrics queue
+            # fill up as well, which in turn holds the prober back
+            producer.poll(1)
+    # Serve delivery reports of previously sent metrics, without blocking
+    producer.poll(0)
 
 
-def produce(producer: Producer, metric: Metric):
-    producer.produce(
-        json.dumps(dict(metric), default=format_unsupported_types).encode('utf-8')
-    )
+def probe(url: SplitResult, conn: http.client.HTTPConnection, args) -> Metric:
+    port = url.port or (443 if url.scheme == 'https' else 80)
+    metric = Metric(conn)
+    metric.time_connect(host=url.hostname, port=port)
+    if not metric.tcp_exception:
+        data, content_type = metric.time_http(url=url, follow_redirect=args.follow_redirect,
+                                              need_body=bool(args.search_in_content))
+        if args.search_in_content and not metric.tcp_exception:
+            metric.content_found = match_content(args.search_in_content, data, content_type)
+    return metric
+
+
+def start_prober(url: SplitResult, args, metrics: queue.Queue, stop: threading.Event, errors: list):
+    conn = None
+    try:
+        conn = open_connection(url, timeout=args.timeout)
+        while not stop.is_set():
+            # Blocks while the queue is full, so a stalled Kafka can't pile up metrics in memory
+            metrics.put(probe(url, conn, args))
+            # Wakes up either after the delay, or right away on exit
+            stop.wait(timeout=args.delay)
+    except Exception as e:
+        # Handed over to the main thread, so that the process still fails on it
+        errors.append(e)
+    finally:
+        if conn:
+            conn.close()
+        # Tell the producing side that there will be no more metrics
+        metrics.put(None)
 
 
 def work(args):
     config = args.config
 
-    url = urllib3.util.parse_url(args.url)
-    port = url.port or (443 if url.scheme == 'https' else 80)
-    state = {"running": True}
+    url = parse_url(args.url)
+    stop = threading.Event()
 
     # Inspired by https://stackoverflow.com/a/31464349
     def proper_exit(signum, frame):
-        state["running"] = False
+        stop.set()
 
     signal.signal(signal.SIGINT, proper_exit)
     signal.signal(signal.SIGTERM, proper_exit)
 
-    connection = connect_kafka(config["kafka"])
-    topic = connection.topics[config["kafka"]["topic"]]
-    # Won't check for delivery reports. Too much work for now
-    # Won't use sync variant because we need to focus on gathering data, not block while trying to send it
-    with topic.get_producer() as producer:
+    producer = connect_kafka(config["kafka"])
+    topic = config["kafka"]["topic"]
+    # Probe in the background, so that measuring never waits for Kafka
+    metrics = queue.Queue(maxsize=32)
+    errors = []
+    prober = threading.Thread(target=start_prober, args=(url, args, metrics, stop, errors), daemon=True)
+    prober.start()
+    # Won't wait for each delivery because we need to focus on gathering data, not block while trying to send it.
+    # The producer is only flushed on shutdown
+    try:
         while True:
-            metric = Metric()
-            metric.time_connect(host=url.host, port=port)
-            if not metric.tcp_exception:
-                data, content_type = metric.time_http(url=args.url, follow_redirect=args.follow_redirect)
-                if args.search_in_content:
-                    metric.content_found = match_content(args.search_in_content, data, content_type)
-            produce(producer, metric)
-            # Opt for sleeping N * 1 seconds rather than N seconds to be able to have a proper exit
-            for i in range(args.delay):
-                if not state["running"]:
-                    print("Exiting")
-                    exit()
-                time.sleep(1)
+            metric = metrics.get()
+            if metric is None:
+                break
+            produce(producer, topic, metric, stop)
+    finally:
+        # Don't hang on exit when Kafka is unreachable
+        undelivered = producer.flush(FLUSH_TIMEOUT)
+        if undelivered:
+            print(f"Gave up on delivering {undelivered} metrics")
+    if errors:
+        raise errors[0]
+    print("Exiting")
 
 
 def main():
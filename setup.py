@@ -14,12 +14,11 @@ setup(
     long_description=get_long_description(),
     long_description_content_type='text/markdown',
 
-    python_requires='~=3.6',
+    python_requires='~=3.7',
 
     install_requires=[
-        'urllib3',
-        'pytz',
-        'pykafka',
+        'msgpack',
+        'confluent-kafka',
         'psycopg2-binary'
     ],
 
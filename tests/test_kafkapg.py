@@ -1,5 +1,12 @@
+import datetime
+import http.client
 from io import StringIO
-from pynger import pynger
+import msgpack
+import queue
+from pynger import kafkapg, pynger
+import re
+import socket
+import threading
 import unittest
 from types import SimpleNamespace
 
@@ -26,16 +33,71 @@ class MyTestCase(unittest.TestCase):
         assert hasattr(args, "foo")
         assert args.foo == "bar"
 
+    def test_parse_url(self):
+        url = pynger.parse_url("google.com")
+        assert url.scheme == 'http'
+        assert url.hostname == 'google.com'
+        assert pynger.request_path(url) == '/'
+
+        url = pynger.parse_url("https://example.com:8443/foo?bar=1#baz")
+        assert url.scheme == 'https'
+        assert url.port == 8443
+        assert pynger.request_path(url) == '/foo?bar=1'
+
     def test_get_charset(self):
         assert pynger.get_charset("test/html; charset=UTF-8") == 'UTF-8'
         assert pynger.get_charset(";charset=ISO-8859-1") == 'ISO-8859-1'
         assert pynger.get_charset("charset=ISO-8859-1") == 'ISO-8859-1'
         assert pynger.get_charset("CHARSET = ISO-8859-1") == 'ISO-8859-1'
+        assert pynger.get_charset('text/html; charset="utf-8"; foo=bar') == 'utf-8'
+        assert pynger.get_charset("text/html") is None
+        assert pynger.get_charset(None) is None
 
     def test_match_content(self):
-        assert pynger.match_content('abc', b"babcebcabc", 'charset=UTF-8')
-        assert pynger.match_content('a[b]?c', b"bacebcaby", 'charset=UTF-8')
-        assert not pynger.match_content('a[b]?c', b"baebcabz", 'charset=UTF-8')
+        assert pynger.match_content(re.compile('abc'), b"babcebcabc", 'charset=UTF-8')
+        assert pynger.match_content(re.compile('a[b]?c'), b"bacebcaby", 'charset=UTF-8')
+        assert not pynger.match_content(re.compile('a[b]?c'), b"baebcabz", 'charset=UTF-8')
+        assert pynger.match_content(re.compile('caf[ée]'), "un café".encode('ISO-8859-1'), 'charset=ISO-8859-1')
+        assert not pynger.match_content(re.compile('caf[ée]'), b"un cafa", 'charset=UTF-8')
+        assert not pynger.match_content(re.compile('caf[ée]'), b"un caf\xe9", 'charset=UTF-8')
+        assert not pynger.match_content(re.compile('caf[ée]'), b"un cafe", 'charset=no-such-charset')
+        # Expressions with unicode semantics are searched in the decoded text
+        assert pynger.match_content(re.compile(r'caf\w'), "un café".encode('UTF-8'), 'charset=UTF-8')
+        assert pynger.match_content(re.compile('(?i)CAFÉ'), "un café".encode('UTF-8'), 'charset=UTF-8')
+        assert pynger.match_content(re.compile('(?i)CAF'), "un café".encode('UTF-8'), 'charset=UTF-8')
+        # Wildcards, negated classes and counts apply to characters, not to bytes
+        assert pynger.match_content(re.compile('a.b'), "<title>aéb</title>".encode('UTF-8'), 'charset=UTF-8')
+        assert pynger.match_content(re.compile('>[^<]{3}<'), "<title>aéb</title>".encode('UTF-8'), 'charset=UTF-8')
+        # Escapes stand for characters, not bytes
+        assert pynger.match_content(re.compile(r'caf\xe9'), "un café".encode('UTF-8'), 'charset=UTF-8')
+        assert pynger.match_content(re.compile(r'caf\u00e9'), "un café".encode('UTF-8'), 'charset=UTF-8')
+        assert pynger.match_content(re.compile(r'caf\N{LATIN SMALL LETTER E WITH ACUTE}'),
+                                    "un café".encode('UTF-8'), 'charset=UTF-8')
+        # Charsets whose bytes may look like ASCII without being ASCII are decoded too
+        assert pynger.match_content(re.compile('abc'), "babcebcabc".encode('UTF-16'), 'charset=UTF-16')
+        assert pynger.match_content(re.compile('abc'), "babcebcabc".encode('UTF-32'), 'charset=UTF-32')
+        assert not pynger.match_content(re.compile('q'), '〈'.encode('shift_jis'), 'charset=Shift_JIS')
+
+    def test_get_raw_literal(self):
+        assert pynger.get_raw_literal(re.compile('abc')) == b'abc'
+        assert pynger.get_raw_literal(re.compile(r'a\.b\(c\)')) == b'a.b(c)'
+        assert pynger.get_raw_literal(re.compile('a[b]?c')) is None
+        assert pynger.get_raw_literal(re.compile('a.b')) is None
+        assert pynger.get_raw_literal(re.compile('ab{2}')) is None
+        assert pynger.get_raw_literal(re.compile(r'caf\xe9')) is None
+        assert pynger.get_raw_literal(re.compile(r'caf\u00e9')) is None
+        assert pynger.get_raw_literal(re.compile('caf[ée]')) is None
+        assert pynger.get_raw_literal(re.compile(r'caf\w')) is None
+        assert pynger.get_raw_literal(re.compile('(?i)cafe')) is None
+        assert pynger.get_raw_literal(re.compile('cafe', re.I)) is None
+
+    def test_is_raw_searchable(self):
+        assert pynger.is_raw_searchable('UTF-8')
+        assert pynger.is_raw_searchable('us-ascii')
+        assert pynger.is_raw_searchable('ISO-8859-1')
+        assert not pynger.is_raw_searchable('UTF-16')
+        assert not pynger.is_raw_searchable('Shift_JIS')
+        assert not pynger.is_raw_searchable('no-such-charset')
 
     def test_time_connect(self):
         metric = pynger.Metric()
@@ -51,9 +113,11 @@ class MyTestCase(unittest.TestCase):
         assert metric.tcp_exception is not None
 
     def test_time_http(self):
+        url = pynger.parse_url("http://github.com")
+
         # test with redirect-awareness
-        metric = pynger.Metric()
-        data, content_type = metric.time_http("http://github.com", follow_redirect=True)
+        metric = pynger.Metric(pynger.open_connection(url))
+        data, content_type = metric.time_http(url, follow_redirect=True)
         assert data is not None
         assert content_type is not None
         assert metric.total_rt > 0
@@ -64,8 +128,8 @@ class MyTestCase(unittest.TestCase):
         assert metric.num_redirects > 0
 
         # test without redirect-awareness
-        metric = pynger.Metric()
-        data, content_type = metric.time_http("http://github.com", follow_redirect=False)
+        metric = pynger.Metric(pynger.open_connection(url))
+        data, content_type = metric.time_http(url, follow_redirect=False)
         assert data is not None
         assert content_type is None
         assert metric.total_rt > 0
@@ -75,6 +139,62 @@ class MyTestCase(unittest.TestCase):
         assert metric.final_response_code == metric.initial_response_code
         assert metric.num_redirects == 0
 
+        # test without downloading the body
+        metric = pynger.Metric(pynger.open_connection(url))
+        data, content_type = metric.time_http(url, follow_redirect=True,
+                                              need_body=False)
+        assert data == b''
+        assert content_type is not None
+        assert 300 <= metric.initial_response_code < 400
+
+
+    def test_time_http_timeout(self):
+        # A host that accepts connections but never answers
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        try:
+            url = pynger.parse_url(f"http://127.0.0.1:{server.getsockname()[1]}")
+            metric = pynger.Metric(pynger.open_connection(url, timeout=0.2))
+            data, content_type = metric.time_http(url, follow_redirect=False)
+            assert data == b''
+            assert content_type is None
+            assert isinstance(metric.tcp_exception, TimeoutError)
+            assert metric.initial_response_code is None
+        finally:
+            server.close()
+
+    def test_time_http_failure(self):
+        # A host that hangs up without answering
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(4)
+        threading.Thread(target=lambda: server.accept()[0].close(), daemon=True).start()
+        try:
+            url = pynger.parse_url(f"http://127.0.0.1:{server.getsockname()[1]}")
+            metric = pynger.Metric(pynger.open_connection(url, timeout=1))
+            data, content_type = metric.time_http(url, follow_redirect=False)
+            # Recorded as a failed probe
+            assert data == b''
+            assert content_type is None
+            assert isinstance(metric.tcp_exception, (http.client.RemoteDisconnected, ConnectionResetError))
+            assert metric.initial_response_code is None
+        finally:
+            server.close()
+
+        # Without a connection there is nothing to time
+        with self.assertRaises(ValueError):
+            pynger.Metric().time_http(url, follow_redirect=False)
+
+    def test_start_prober_error(self):
+        url = pynger.parse_url("http://127.0.0.1:99999")
+        args = SimpleNamespace(timeout=1, delay=60, follow_redirect=False, search_in_content=None)
+        metrics, errors = queue.Queue(), []
+        pynger.start_prober(url, args, metrics, threading.Event(), errors)
+        # The failure is kept for the main thread, and the producing side is told to stop
+        assert len(errors) == 1
+        assert isinstance(errors[0], ValueError)
+        assert metrics.get_nowait() is None
 
     def test_metric_dict(self):
         metric = pynger.Metric()
@@ -90,6 +210,118 @@ class MyTestCase(unittest.TestCase):
             "content_found",
             "timestamp"
         }
+        assert metric.as_dict() == asdict
+
+    def test_row_from_message(self):
+        timestamp = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        message = SimpleNamespace(value=lambda: msgpack.packb({
+            "tcp_exception": None,
+            "tcp_rt": 1.5,
+            "http_rt": 20.25,
+            "initial_response_code": 301,
+            "num_redirects": 1,
+            "total_rt": 40.5,
+            "final_response_code": 200,
+            "content_found": True,
+            "timestamp": timestamp
+        }, datetime=True))
+        assert kafkapg.row_from_message(message) == (
+            timestamp, None, 1.5, 20.25, 301, 1, 40.5, 200, True
+        )
+
+    def test_read_batch(self):
+        def message(value, offset, error=None):
+            return SimpleNamespace(value=lambda: value, error=lambda: error, offset=lambda: offset,
+                                   topic=lambda: "metrics", partition=lambda: 0)
+
+        timestamp = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        metric = msgpack.packb({
+            "tcp_exception": None,
+            "tcp_rt": 1.5,
+            "http_rt": 20.25,
+            "initial_response_code": 301,
+            "num_redirects": 1,
+            "total_rt": 40.5,
+            "final_response_code": 200,
+            "content_found": True,
+            "timestamp": timestamp
+        }, datetime=True)
+        rows, offsets = kafkapg.read_batch([
+            message(metric, 10),
+            # Written as JSON by an earlier version of the producer
+            message(b"""{"tcp_exception": "Connection timed out after 1 seconds", "tcp_rt": 0, "http_rt": 0,
+                "initial_response_code": null, "num_redirects": 0, "total_rt": 0, "final_response_code": null,
+                "content_found": null, "timestamp": "2020-01-01T00:01:00.5Z"}""", 11),
+            message(b"""{"tcp_exception": null, "tcp_rt": 1.5, "http_rt": 20.25, "initial_response_code": 200,
+                "num_redirects": 0, "total_rt": 20.25, "final_response_code": 200, "content_found": null,
+                "timestamp": "2020-01-01 00:02:00+0000"}""", 12),
+            # Not decodable
+            message(b'{"tcp_exception": null, "tcp_rt": 1.5}', 13),
+            message(msgpack.packb({"tcp_rt": 1.5}), 14),
+            message(b'\xc1', 15),
+            message(None, 16, error="Broker: Unknown topic"),
+        ])
+        assert rows == [
+            (timestamp, None, 1.5, 20.25, 301, 1, 40.5, 200, True),
+            (datetime.datetime(2020, 1, 1, 0, 1, 0, 500000, tzinfo=datetime.timezone.utc),
+             "Connection timed out after 1 seconds", 0, 0, None, 0, 0, None, None),
+            (datetime.datetime(2020, 1, 1, 0, 2, tzinfo=datetime.timezone.utc),
+             None, 1.5, 20.25, 200, 0, 20.25, 200, None)
+        ]
+        # Undecodable messages are acknowledged too, errors are not
+        assert [(o.topic, o.partition, o.offset) for o in offsets] == [("metrics", 0, 16)]
+
+    def test_insert_metrics(self):
+        first = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        second = datetime.datetime(2020, 1, 1, 0, 1, tzinfo=datetime.timezone.utc)
+        calls = []
+        curs = SimpleNamespace(execute=lambda sql, params: calls.append((sql, params)))
+        kafkapg.insert_metrics(curs, [
+            (first, None, 1.5, 20.25, 301, 1, 40.5, 200, True),
+            (second, "Connection timed out after 1 seconds", 0, 0, None, 0, 0, None, None)
+        ])
+        assert len(calls) == 1
+        sql, params = calls[0]
+        assert sql.startswith("EXECUTE insert_metrics")
+        assert sql.count("%s") == len(params) == 9
+        # One list per column, in row order
+        assert params == (
+            [first, second],
+            [None, "Connection timed out after 1 seconds"],
+            [1.5, 0],
+            [20.25, 0],
+            [301, None],
+            [1, 0],
+            [40.5, 0],
+            [200, None],
+            [True, None]
+        )
+
+    def test_produce_backpressure(self):
+        sent, polls = [], []
+
+        def produce(topic, value, callback):
+            # Full on the first attempt
+            if not polls:
+                raise BufferError("Local: Queue full")
+            sent.append((topic, value))
+
+        producer = SimpleNamespace(produce=produce, poll=polls.append)
+        pynger.produce(producer, "metrics", pynger.Metric(), threading.Event())
+        assert len(sent) == 1
+        assert sent[0][0] == "metrics"
+        # Waited for room before trying again, then served the delivery reports
+        assert polls == [1, 0]
+
+        # Gives up once asked to stop
+        stop = threading.Event()
+        stop.set()
+        sent.clear()
+        pynger.produce(producer, "metrics", pynger.Metric(), stop)
+        assert sent == []
+
+    def test_format_unsupported_types(self):
+        assert pynger.format_unsupported_types(TimeoutError("Connection timed out")) == "Connection timed out"
 
 
 if __name__ == '__main__':